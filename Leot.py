@@ -1,19 +1,26 @@
 import os
 from dotenv import load_dotenv
 import logging
-import requests
+import httpx
+import aiofiles
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+import http.cookiejar
 import json
 import time
-import schedule
 import telegram
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler, filters
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler, TypeHandler, filters
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
 import re
+import html
 import urllib.parse
-from datetime import datetime
+import functools
+from datetime import datetime, time as dtime
+from zoneinfo import ZoneInfo
 from pathlib import Path
+from collections import Counter, OrderedDict, deque
 import asyncio
 
 load_dotenv()
@@ -27,12 +34,21 @@ logger = logging.getLogger(__name__)
 # Constants for ConversationHandler states
 SELECTING_MODULE, SELECTING_CHAT, CONFIRM_ADDITION = range(3)
 
+# Seconds before an unfinished /addmodule conversation is dropped
+ADD_MODULE_TIMEOUT = 5 * 60
+
+# Chat ID input: a numeric chat ID, optionally followed by "_<topic ID>"
+TOPIC_RE = re.compile(r"^(-?\d+)(?:_(\d+))?$")
+
+# Callback data fields are separated by "|", which can't clash with "_" in IDs:
+# "chat|<chat ID>", "rm|<module ID>" and "cr|<keep/delete>|<module ID>"
+
 # Data storage paths
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 MODULES_FILE = DATA_DIR / "modules.json"
 SENT_LINKS_FILE = DATA_DIR / "sent_links.json"
-COOKIES_FILE = DATA_DIR / "cookies.json"
+COOKIES_FILE = DATA_DIR / "cookies.txt"
 
 # Initialize data directory
 DATA_DIR.mkdir(exist_ok=True)
@@ -41,6 +57,46 @@ DATA_DIR.mkdir(exist_ok=True)
 DEFAULT_MODULES = {}
 DEFAULT_SENT_LINKS = {}
 
+# Maximum number of module pages fetched at the same time
+MAX_CONCURRENT_CHECKS = 8
+# Maximum number of link probes (HEAD/ranged GET) in flight at the same time, across all pages
+MAX_CONCURRENT_PROBES = 8
+# Connections kept open to the Telegram Bot API
+BOT_POOL_SIZE = 16
+
+# Download chunk size and file write buffer size
+DOWNLOAD_CHUNK_SIZE = 1 << 18
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Sent links remembered per module and chat (older ones are dropped)
+SENT_LINKS_HISTORY = 2000
+
+# Number of link classifications remembered between polls
+CLASSIFY_CACHE_SIZE = 2048
+
+# Attempts for network requests and Telegram sends before giving up
+MAX_ATTEMPTS = 5
+
+# Seconds a login is trusted before checks log in again
+SESSION_TTL = 30 * 60
+
+# Seconds to wait before writing pending data changes to disk
+FLUSH_DELAY = 5
+
+# Bytes requested when a HEAD probe isn't enough (Moodle redirect pages are tiny)
+PROBE_RANGE = "bytes=0-16384"
+
+# Patterns used while scanning module pages and naming files
+_WINDOW_OPEN_RE = re.compile(r"window\.open\('([^']+)'")
+_NAME_SUFFIX_RE = re.compile(r'\s*(Fichier|URL|Dossier|Document|File|Link|Resource)\s*$', re.IGNORECASE)
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\.-]')
+_FIRST_HREF_RE = re.compile(r'<a\s(?:[^>]*?\s)?href\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+# Only the resource/URL activities of a course page are parsed
+_ACTIVITY_STRAINER = SoupStrainer('li', class_=re.compile(r'\bmodtype_(resource|url)\b'))
+RESOURCE_CLASSES = {'activity', 'resource', 'modtype_resource'}
+URL_CLASSES = {'activity', 'url', 'modtype_url'}
+
 # Load configuration
 def load_config():
     """Load bot configuration from environment variables"""
@@ -49,6 +105,11 @@ def load_config():
         "USERNAME": os.environ.get("UNIV_USERNAME", ""),
         "PASSWORD": os.environ.get("UNIV_PASSWORD", ""),
         "ADMIN_ID": int(os.environ.get("ADMIN_ID", "0")),
+        # Public base URL for webhook mode; leave empty to use polling
+        "WEBHOOK_URL": os.environ.get("WEBHOOK_URL", ""),
+        "WEBHOOK_PORT": int(os.environ.get("WEBHOOK_PORT", "8443")),
+        # IANA time zone of the daily check, so it follows DST changes
+        "TIMEZONE": os.environ.get("TIMEZONE", "Africa/Algiers"),
         "LOGIN_URL": "https://elearning.univ-constantine2.dz/elearning/login/index.php",
         "BASE_URL": "https://elearning.univ-constantine2.dz/elearning/"
     }
@@ -56,19 +117,37 @@ def load_config():
 CONFIG = load_config()
 
 # Load and save JSON data
+def json_default(obj):
+    """Serialize types the JSON encoder doesn't know about"""
+    if isinstance(obj, deque):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+# Prefer orjson when installed, it is several times faster than the json module
+try:
+    import orjson
+    
+    def FAST_JSON_DUMPS(data):
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    
+    FAST_JSON_LOADS = orjson.loads
+except ImportError:
+    def FAST_JSON_DUMPS(data):
+        return json.dumps(data, default=json_default, indent=2, ensure_ascii=False).encode('utf-8')
+    
+    FAST_JSON_LOADS = json.loads
+
 def load_json(file_path, default_data):
     """Load JSON data from file or return default if file doesn't exist or is invalid"""
     try:
         if file_path.exists():
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                if content:  # Check if file is not empty
-                    return json.loads(content)
+            content = file_path.read_bytes().strip()
+            if content:  # Check if file is not empty
+                return FAST_JSON_LOADS(content)
         
         # Either file doesn't exist or is empty
         # Create the file with default data
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(default_data, f, indent=2, ensure_ascii=False)
+        save_json(file_path, default_data)
         return default_data
     except Exception as e:
         print(f"Error loading JSON from {file_path}: {e}")
@@ -78,53 +157,188 @@ def load_json(file_path, default_data):
 def save_json(file_path, data):
     """Save data to JSON file"""
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        write_json_bytes(file_path, FAST_JSON_DUMPS(data))
     except Exception as e:
         print(f"Error saving JSON to {file_path}: {e}")
 
+def write_json_bytes(file_path, content):
+    """Write already serialized JSON to file"""
+    try:
+        # Write to a temporary file first so a crash never leaves a half-written file
+        tmp_path = file_path.with_suffix('.tmp')
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, file_path)
+    except Exception as e:
+        print(f"Error writing JSON to {file_path}: {e}")
+
+# Link helpers
+# urlsplit skips urlparse's ";params" handling; cached since admins often retry the same URL
+_split_url = functools.lru_cache(maxsize=256)(urllib.parse.urlsplit)
+
+def sent_history(urls=()):
+    """Bounded history of sent links, keeping only the most recent ones"""
+    return deque(urls, maxlen=SENT_LINKS_HISTORY)
+
+def drive_file_id(url):
+    """Extract the file ID from a Google Drive URL, or None"""
+    if 'drive.google.com' not in url:
+        return None
+    if '/file/d/' in url:
+        return url.split('/file/d/')[1].split('/')[0]
+    if 'id=' in url:
+        return url.split('id=')[1].split('&')[0]
+    return None
+
+def first_link(page):
+    """Get the target of the first link in a small HTML page, like Moodle's redirect pages"""
+    match = _FIRST_HREF_RE.search(page)
+    return html.unescape(match.group(1)) if match else None
+
+def classify_by_url(url, name):
+    """Classify a link from its URL alone when that's unambiguous, or return None"""
+    if not url.startswith(('http://', 'https://')):
+        return None
+    if 'drive.google.com/file/d/' in url:
+        return {"url": url, "name": name, "type": "drive", "final_url": url}
+    if url.lower().split('?', 1)[0].endswith('.pdf'):
+        return {"url": url, "name": name, "type": "pdf", "final_url": url}
+    return None
+
+def canonical_link_key(url):
+    """Cache key for a link: the Drive file ID if there is one, else the URL without its fragment"""
+    file_id = drive_file_id(url)
+    if file_id:
+        return f"drive:{file_id}"
+    return url.split('#', 1)[0]
+
+# Retry policy for network requests
+def is_transient_error(exc):
+    """Tell whether a request error is worth retrying (connection problems and 5xx responses)"""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.is_server_error
+
+network_retry = retry(
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
+)
+
+async def send_with_retry(send, **kwargs):
+    """Call a Telegram send method, waiting out flood control between attempts"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await send(**kwargs)
+        except telegram.error.RetryAfter as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            logger.warning(f"Rate limited. Waiting {e.retry_after} seconds")
+            await asyncio.sleep(e.retry_after)
+
 # Session management
 class UnivSession:
     """Class to manage university e-learning platform session"""
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        })
+        # Cookies live in an LWP cookie jar file, saved only when the server sets new ones
+        self._cookie_jar = http.cookiejar.LWPCookieJar(str(COOKIES_FILE))
+        self._cookies_changed = False
+        
+        # One pooled client for the whole session so TCP/TLS connections are reused
+        self.client = httpx.AsyncClient(
+            cookies=self._cookie_jar,
+            event_hooks={'response': [self._track_cookies]},
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            http2=True,
+            timeout=30.0,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            }
+        )
+        
+        # Hidden login form fields, scraped once; only the token is re-read afterwards
+        self._login_hidden = {}
+        self._login_token_name = None
+        self._login_token_re = None
+        
+        # Handlers share this session, so concurrent logins collapse into one
+        self._login_lock = asyncio.Lock()
+        self._login_count = 0
+        self._last_login_ok = False
+        # Monotonic deadline until which the last login is considered valid
+        self._authed_until = 0
         self.load_cookies()
     
     def load_cookies(self):
         """Load saved cookies if available"""
         try:
-            if COOKIES_FILE.exists():
-                with open(COOKIES_FILE, 'r') as f:
-                    content = f.read().strip()
-                    if content:  # Check if file is not empty
-                        cookies = json.loads(content)
-                        for cookie in cookies:
-                            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'])
-                    else:
-                        # File exists but is empty, no cookies to load
-                        return
-            else:
-                # File doesn't exist, no cookies to load
-                return
+            if COOKIES_FILE.exists() and COOKIES_FILE.stat().st_size > 0:
+                # Session cookies are marked discard, keep them anyway
+                self._cookie_jar.load(ignore_discard=True)
         except Exception as e:
             # Log error but continue without cookies
             print(f"Error loading cookies: {e}")
-            return
     
     def save_cookies(self):
-        """Save current session cookies"""
-        cookies = [{'name': c.name, 'value': c.value, 'domain': c.domain} for c in self.session.cookies]
-        with open(COOKIES_FILE, 'w') as f:
-            json.dump(cookies, f)
+        """Save current session cookies if they changed"""
+        if not self._cookies_changed:
+            return
+        self._cookie_jar.save(ignore_discard=True)
+        self._cookies_changed = False
+    
+    async def _track_cookies(self, response):
+        """Remember that cookies changed whenever a response sets any"""
+        if response.headers.get_list('set-cookie'):
+            self._cookies_changed = True
+    
+    async def close(self):
+        """Close the underlying HTTP client and its pooled connections"""
+        await self.client.aclose()
+    
+    def _login_fields(self, page):
+        """Get the hidden login form fields, only parsing the whole form the first time"""
+        # Fast path: the static fields are known, just pick up the fresh token
+        if self._login_token_re is not None:
+            match = self._login_token_re.search(page)
+            if match:
+                return {**self._login_hidden, self._login_token_name: match.group(1)}
+        
+        soup = BeautifulSoup(page, 'lxml')
+        fields = {}
+        for input_field in soup.select('form input[type="hidden"]'):
+            if input_field.get('name') and input_field.get('value'):
+                fields[input_field['name']] = input_field['value']
+        
+        # Remember which field carries the per-session token (Moodle's "logintoken")
+        token_name = next((name for name in fields if 'token' in name.lower()), None)
+        if token_name:
+            self._login_token_name = token_name
+            self._login_token_re = re.compile(rf'name="{re.escape(token_name)}" value="([^"]+)"')
+            self._login_hidden = {name: value for name, value in fields.items() if name != token_name}
+        return fields
     
     async def login(self):
         """Login to the university e-learning platform"""
+        logins_seen = self._login_count
+        async with self._login_lock:
+            # Someone else logged in while we waited, reuse their result
+            if self._login_count != logins_seen:
+                return self._last_login_ok
+            self._last_login_ok = await self._do_login()
+            self._login_count += 1
+            self._authed_until = time.monotonic() + SESSION_TTL if self._last_login_ok else 0
+            return self._last_login_ok
+    
+    async def ensure_logged_in(self):
+        """Login only if the last successful login is older than SESSION_TTL"""
+        if time.monotonic() < self._authed_until:
+            return True
+        return await self.login()
+    
+    async def _do_login(self):
+        """Submit the login form"""
         # First request to get the login form
-        login_page = self.session.get(CONFIG["LOGIN_URL"])
-        soup = BeautifulSoup(login_page.text, 'html.parser')
+        login_page = await self.client.get(CONFIG["LOGIN_URL"], follow_redirects=True)
         
         # Prepare login form data
         login_data = {
@@ -132,13 +346,11 @@ class UnivSession:
             'password': CONFIG["PASSWORD"],
         }
         
-        # Look for any hidden fields to include in form submission
-        for input_field in soup.select('form input[type="hidden"]'):
-            if input_field.get('name') and input_field.get('value'):
-                login_data[input_field['name']] = input_field['value']
+        # Include the hidden fields in form submission
+        login_data.update(self._login_fields(login_page.text))
         
         # Submit login form
-        response = self.session.post(CONFIG["LOGIN_URL"], data=login_data)
+        response = await self.client.post(CONFIG["LOGIN_URL"], data=login_data, follow_redirects=True)
         
         # Check if login was successful
         if "loginerrors" in response.text or "Invalid login" in response.text:
@@ -150,57 +362,96 @@ class UnivSession:
         logger.info("Login successful")
         return True
     
+    @network_retry
+    async def _get(self, url):
+        """GET a URL, raising on server errors so they get retried"""
+        response = await self.client.get(url, follow_redirects=True)
+        if response.is_server_error:
+            response.raise_for_status()
+        return response
+    
     async def get_page(self, url):
         """Get page content, login again if session expired"""
-        response = self.session.get(url)
-        if "loginerrors" in response.text or "You are not logged in" in response.text:
-            logger.info("Session expired, logging in again")
-            if await self.login():
-                response = self.session.get(url)
-            else:
-                return None
+        try:
+            response = await self._get(url)
+            if "loginerrors" in response.text or "You are not logged in" in response.text:
+                logger.info("Session expired, logging in again")
+                self._authed_until = 0
+                if await self.login():
+                    response = await self._get(url)
+                else:
+                    return None
+        except httpx.HTTPError as e:
+            logger.error(f"Error fetching page {url}: {e}")
+            return None
         return response.text
 
+    @network_retry
+    async def probe(self, url):
+        """Fetch just enough of a URL to classify it: headers first, a small body only if needed"""
+        response = await self.client.head(url, follow_redirects=True)
+        content_type = response.headers.get('Content-Type', '')
+        
+        # HTML pages may be redirect pages, and some servers refuse HEAD
+        if response.is_error or 'text/html' in content_type:
+            response = await self.client.get(url, headers={"Range": PROBE_RANGE}, follow_redirects=True)
+        return response
+
+    async def _save_stream(self, response, file_path):
+        """Write a streamed response body to disk without blocking the event loop"""
+        async with aiofiles.open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+
+    @network_retry
+    async def _fetch_to_file(self, download_url, url, file_path):
+        """Stream download_url into file_path, following Moodle redirect pages"""
+        actual_url = None
+        async with self.client.stream('GET', download_url, follow_redirects=True) as response:
+            # Check status code
+            if response.is_server_error:
+                response.raise_for_status()
+            if response.status_code != 200:
+                logger.error(f"Download failed with status code: {response.status_code}")
+                return False
+            
+            # If it's a redirect URL (like Moodle's redirect), follow the chain
+            # (the file itself may come straight back, so only parse HTML pages)
+            is_html = 'text/html' in response.headers.get('Content-Type', '')
+            if is_html and ("url/view.php" in url or "resource/view.php" in url):
+                await response.aread()
+                actual_url = first_link(response.text)
+            
+            # Create the file
+            if actual_url is None:
+                await self._save_stream(response, file_path)
+        
+        if actual_url:
+            async with self.client.stream('GET', actual_url, follow_redirects=True) as response:
+                if response.is_server_error:
+                    response.raise_for_status()
+                await self._save_stream(response, file_path)
+        return True
+
     async def download_file(self, url, filename):
         """Download a file from the given URL"""
         try:
+            download_url = url
             # Special handling for Google Drive URLs
             if 'drive.google.com' in url:
                 # Extract file ID from Drive URL
-                file_id = None
-                if '/file/d/' in url:
-                    file_id = url.split('/file/d/')[1].split('/')[0]
-                elif 'id=' in url:
-                    file_id = url.split('id=')[1].split('&')[0]
+                file_id = drive_file_id(url)
                 
                 if file_id:
                     # Use the direct download link format
-                    direct_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-                    response = self.session.get(direct_url, stream=True, allow_redirects=True)
+                    download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
                 else:
                     logger.error(f"Could not extract file ID from Drive URL: {url}")
                     return None
-            else:
-                response = self.session.get(url, stream=True, allow_redirects=True)
-
-            # Check status code
-            if response.status_code != 200:
-                logger.error(f"Download failed with status code: {response.status_code}")
-                return None
-            
-            # If it's a redirect URL (like Moodle's redirect), follow the chain
-            if "url/view.php" in url or "resource/view.php" in url:
-                soup = BeautifulSoup(response.text, 'html.parser')
-                redirect_link = soup.find('a', href=True)
-                if redirect_link:
-                    actual_url = redirect_link['href']
-                    response = self.session.get(actual_url, stream=True, allow_redirects=True)
             
-            # Create the file
             file_path = DATA_DIR / filename
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            if not await self._fetch_to_file(download_url, url, file_path):
+                return None
             
             # Check if file was downloaded and has content
             if file_path.exists() and file_path.stat().st_size > 0:
@@ -216,6 +467,17 @@ class UnivSession:
             logger.error(f"Error downloading file: {e}")
             return None
 
+    async def download_bytes(self, url, filename):
+        """Download a file and return its content, leaving nothing on disk"""
+        file_path = await self.download_file(url, filename)
+        if not file_path:
+            return None
+        try:
+            async with aiofiles.open(file_path, 'rb') as f:
+                return await f.read()
+        finally:
+            file_path.unlink()
+
 # PDF Detection and Processing
 class PDFMonitor:
     """Class to monitor and detect new PDFs on module pages"""
@@ -229,12 +491,74 @@ class PDFMonitor:
             # If there's an error, use default values
             self.modules = DEFAULT_MODULES
             self.sent_links = DEFAULT_SENT_LINKS
+        
+        # Bounded in-memory histories, with sets mirroring them for fast "already sent?" checks
+        self._sent_sets = {}
+        for module_id, chats in self.sent_links.items():
+            if isinstance(chats, dict):
+                for chat_id, urls in chats.items():
+                    if isinstance(urls, list):
+                        chats[chat_id] = history = sent_history(urls)
+                        self._sent_sets[(module_id, chat_id)] = set(history)
+        
+        # Limit concurrent requests against the university server
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+        self._probe_sem = asyncio.Semaphore(MAX_CONCURRENT_PROBES)
+        # A manual /check and the daily job must not both send the same new files
+        self._check_lock = asyncio.Lock()
+        
+        # Recent link classifications, keyed by canonical_link_key (LRU order)
+        self._classify_cache = OrderedDict()
+        
+        # Pending changes are written by a single deferred writer
+        self._dirty = False
+        self._flush_task = None
+        self._save_lock = asyncio.Lock()
     
     def save_data(self):
         """Save modules and sent links data"""
         save_json(MODULES_FILE, self.modules)
         save_json(SENT_LINKS_FILE, self.sent_links)
     
+    async def flush(self):
+        """Save data only if it changed since the last write"""
+        async with self._save_lock:
+            if self._dirty:
+                self._dirty = False
+                # Serialize on the event loop, where handlers can't change the data
+                # mid-dump, and only hand the file writes to a worker thread
+                try:
+                    modules = FAST_JSON_DUMPS(self.modules)
+                    sent_links = FAST_JSON_DUMPS(self.sent_links)
+                except Exception as e:
+                    logger.error(f"Error serializing data: {e}")
+                    return
+                await asyncio.to_thread(self._write_data, modules, sent_links)
+    
+    def _write_data(self, modules, sent_links):
+        """Write serialized modules and sent links data"""
+        write_json_bytes(MODULES_FILE, modules)
+        write_json_bytes(SENT_LINKS_FILE, sent_links)
+    
+    def _mark_dirty(self):
+        """Flag data as changed and make sure a deferred write is scheduled"""
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+            except RuntimeError:
+                # No event loop running, write right away
+                self._dirty = False
+                self.save_data()
+    
+    async def _flush_loop(self):
+        """Write pending changes every few seconds until there are none left"""
+        while self._dirty:
+            await asyncio.sleep(FLUSH_DELAY)
+            # A running check saves everything once at the end, don't rewrite the files meanwhile
+            if not self._check_lock.locked():
+                await self.flush()
+    
     def add_module(self, module_id, module_name, module_url, chat_id):
         """Add a new module to monitor"""
         self.modules[module_id] = {
@@ -252,35 +576,84 @@ class PDFMonitor:
         # Convert the chat_id to string to ensure consistency
         chat_id_str = str(chat_id)
         if chat_id_str not in self.sent_links[module_id]:
-            self.sent_links[module_id][chat_id_str] = []
+            self.sent_links[module_id][chat_id_str] = sent_history()
             
-        self.save_data()
+        self._mark_dirty()
 
     
     def remove_module(self, module_id):
         """Remove a module from monitoring"""
         if module_id in self.modules:
             del self.modules[module_id]
-            self.save_data()
+            self._mark_dirty()
             return True
         return False
     
+    def delete_history(self, module_id):
+        """Forget all links sent for a module"""
+        if module_id not in self.sent_links:
+            return False
+        del self.sent_links[module_id]
+        for key in [key for key in self._sent_sets if key[0] == module_id]:
+            del self._sent_sets[key]
+        self._mark_dirty()
+        return True
+    
+    def _remember_sent(self, module_id, chat_id, url):
+        """Record a sent link, forgetting the oldest one once the history is full"""
+        history = self.sent_links[module_id][chat_id]
+        sent_urls = self._sent_sets.get((module_id, chat_id))
+        if sent_urls is None:
+            sent_urls = self._sent_sets[(module_id, chat_id)] = set(history)
+        if len(history) == history.maxlen:
+            sent_urls.discard(history[0])
+        history.append(url)
+        sent_urls.add(url)
+        # Only called during a check, which saves once when it's done
+        self._dirty = True
+    
     async def check_modules(self, bot):
         """Check all modules for new PDFs"""
+        async with self._check_lock:
+            await self._check_modules(bot)
+    
+    async def _check_modules(self, bot):
+        """Check all modules for new PDFs and notify their chats"""
         all_new_files = {}
         
-        for module_id, module_info in self.modules.items():
-            new_files = await self.check_module_page(module_id, module_info["url"])
+        # Check all module pages concurrently
+        results = await asyncio.gather(
+            *(self._check_one(module_id, module_info) for module_id, module_info in self.modules.items()),
+            return_exceptions=True
+        )
+        
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error checking module: {result}")
+                continue
+            module_id, new_files = result
             if new_files and isinstance(new_files, list):
                 all_new_files[module_id] = new_files
         
-        # Send notifications for new files
+        # Send notifications for new files. Only files shared by several modules are
+        # kept in memory, and each is dropped after its last send
+        uses = Counter(
+            file_info.get("final_url")
+            for files in all_new_files.values()
+            for file_info in files
+            if isinstance(file_info, dict) and file_info.get("type") in ("pdf", "drive")
+        )
+        downloads = {final_url: None for final_url, count in uses.items() if count > 1}
+        # Modules can be removed while we send, so work from a snapshot
+        targets = {module_id: dict(self.modules[module_id]) for module_id in all_new_files if module_id in self.modules}
         for module_id, files in all_new_files.items():
             if not isinstance(files, list):
                 logger.error(f"Expected files to be a list for module {module_id}, got {type(files)}")
                 continue
-                    
-            module_info = self.modules[module_id]
+            
+            module_info = targets.get(module_id)
+            if module_info is None:
+                continue
             chat_id = module_info["chat_id"]
             
             # Convert chat_id to string for dictionary key
@@ -292,25 +665,41 @@ class PDFMonitor:
                     continue
                     
                 try:
-                    await self.send_file_notification(bot, chat_id, module_info["name"], file_info)
+                    # Stop once the module is removed, without recreating its history
+                    if module_id not in self.modules:
+                        break
+                    
+                    await self.send_file_notification(bot, chat_id, module_info["name"], file_info, downloads)
+                    if module_id not in self.modules:
+                        break
                     
                     # Ensure dictionaries exist
                     if module_id not in self.sent_links:
                         self.sent_links[module_id] = {}
                     if chat_id_str not in self.sent_links[module_id]:
-                        self.sent_links[module_id][chat_id_str] = []
+                        self.sent_links[module_id][chat_id_str] = sent_history()
                     
                     # Add URL to sent links
-                    if "url" in file_info and isinstance(self.sent_links[module_id][chat_id_str], list):
-                        self.sent_links[module_id][chat_id_str].append(file_info["url"])
+                    if "url" in file_info and isinstance(self.sent_links[module_id][chat_id_str], deque):
+                        self._remember_sent(module_id, chat_id_str, file_info["url"])
                     
                     await asyncio.sleep(3)
                 except Exception as e:
                     logger.error(f"Error sending notification: {e}")
+                finally:
+                    final_url = file_info.get("final_url")
+                    if final_url in downloads:
+                        uses[final_url] -= 1
+                        if uses[final_url] <= 0:
+                            del downloads[final_url]
         
-        # Save updated sent links
-        if all_new_files:
-            self.save_data()
+        # Save updated sent links once for the whole poll
+        await self.flush()
+
+    async def _check_one(self, module_id, module_info):
+        """Check a single module page, bounded by the concurrency semaphore"""
+        async with self._sem:
+            return module_id, await self.check_module_page(module_id, module_info["url"])
 
     # Here's the correct implementation of check_module_page
     async def check_module_page(self, module_id, url):
@@ -320,104 +709,104 @@ class PDFMonitor:
             logger.error(f"Failed to get content for module {module_id}")
             return []
         
-        module_info = self.modules[module_id]
+        # The module may have been removed while its page was loading
+        module_info = self.modules.get(module_id)
+        if module_info is None:
+            return []
         chat_id = str(module_info["chat_id"])  # Convert to string
         
         # Initialize if not exists
         if module_id not in self.sent_links:
             self.sent_links[module_id] = {}
         if chat_id not in self.sent_links[module_id]:
-            self.sent_links[module_id][chat_id] = []
+            self.sent_links[module_id][chat_id] = sent_history()
         
-        # Get sent links for this specific chat - ensure it's a list
-        chat_sent_links = self.sent_links[module_id].get(chat_id, [])
-        if not isinstance(chat_sent_links, list):
-            chat_sent_links = []
+        # Get sent links for this specific chat - ensure it's a bounded history
+        chat_sent_links = self.sent_links[module_id].get(chat_id)
+        if not isinstance(chat_sent_links, deque):
+            chat_sent_links = sent_history()
             self.sent_links[module_id][chat_id] = chat_sent_links
+            self._sent_sets.pop((module_id, chat_id), None)
         
-        soup = BeautifulSoup(html_content, 'html.parser')
-        new_files = []
+        # Membership tests go through the in-memory set, not the list
+        sent_urls = self._sent_sets.get((module_id, chat_id))
+        if sent_urls is None:
+            sent_urls = self._sent_sets[(module_id, chat_id)] = set(chat_sent_links)
         
-        # Check for direct resource links (Type 1)
-        for resource in soup.select('li.activity.resource.modtype_resource'):
-            link_tag = resource.select_one('div.activityinstance a')
-            if not link_tag:
+        # Parse in a worker thread so other module checks keep running
+        soup = await asyncio.to_thread(BeautifulSoup, html_content, 'lxml', parse_only=_ACTIVITY_STRAINER)
+        # Links to classify, processed concurrently once the page is scanned
+        pending = []
+        
+        for activity in soup.find_all('li'):
+            classes = set(activity.get('class') or [])
+            if RESOURCE_CLASSES <= classes:
+                # Direct resource link (Type 1), check if it's likely a PDF by following the link
+                process, default_name = self.process_resource_link, "Unnamed resource"
+            elif URL_CLASSES <= classes:
+                # External URL link (Type 2), check if it leads to a PDF or Google Drive
+                process, default_name = self.process_url_link, "Unnamed URL"
+            else:
                 continue
-                
-            # Get URL from href or onclick attribute
-            resource_url = link_tag.get('href')
             
-            # If href is empty, try to extract URL from onclick
-            if not resource_url or resource_url.strip() == '':
-                onclick = link_tag.get('onclick', '')
-                url_match = re.search(r"window\.open\('([^']+)'", onclick)
-                if url_match:
-                    resource_url = url_match.group(1)
-            
-            # If still no URL, skip this resource
-            if not resource_url or resource_url.strip() == '':
-                continue
-                
-            name_tag = link_tag.select_one('span.instancename')
-            resource_name = name_tag.get_text(strip=True) if name_tag else "Unnamed resource"
-
-            
-            # Remove any "URL" or other suffix text from the name
-            resource_name = re.sub(r'<span class="accesshide[^>]*>.*?</span>', '', resource_name)
-            resource_name = resource_name.strip()
-            
-            # Check if this is a new link FOR THIS CHAT
-            if resource_url not in chat_sent_links:
-                # Check if it's likely a PDF by following the link
-                file_info = await self.process_resource_link(resource_url, resource_name)
-                if file_info:
-                    new_files.append(file_info)
-        
-        # Check for external URL links (Type 2)
-        for url_item in soup.select('li.activity.url.modtype_url'):
-            link_tag = url_item.select_one('div.activityinstance a')
+            link_tag = activity.select_one('div.activityinstance a')
             if not link_tag:
                 continue
                 
             # Get URL from href or onclick attribute
-            url_resource = link_tag.get('href')
+            link_url = link_tag.get('href')
             
             # If href is empty, try to extract URL from onclick
-            if not url_resource or url_resource.strip() == '':
+            if not link_url or link_url.strip() == '':
                 onclick = link_tag.get('onclick', '')
-                url_match = re.search(r"window\.open\('([^']+)'", onclick)
+                url_match = _WINDOW_OPEN_RE.search(onclick)
                 if url_match:
-                    url_resource = url_match.group(1)
+                    link_url = url_match.group(1)
             
-            # If still no URL, skip this resource
-            if not url_resource or url_resource.strip() == '':
+            # If still no URL, skip this activity
+            if not link_url or link_url.strip() == '':
                 continue
                 
+            # Clean the name once here: Moodle appends a hidden " Fichier"/" URL"
+            # label, which get_text() keeps separated so the suffix pattern drops it
             name_tag = link_tag.select_one('span.instancename')
-            url_name = name_tag.get_text(strip=True) if name_tag else "Unnamed URL"
-            
-            # Remove any "URL" or other suffix text from the name
-            url_name = re.sub(r'<span class="accesshide[^>]*>.*?</span>', '', url_name)
-            url_name = url_name.strip()
+            if name_tag:
+                link_name = _NAME_SUFFIX_RE.sub('', name_tag.get_text(' ', strip=True)).strip()
+            else:
+                link_name = default_name
             
             # Check if this is a new link FOR THIS CHAT
-            if url_resource not in chat_sent_links:
-                # Check if it leads to a PDF or Google Drive
-                file_info = await self.process_url_link(url_resource, url_name)
-                if file_info:
-                    new_files.append(file_info)
+            if link_url not in sent_urls:
+                pending.append(self._classify(process, link_url, link_name))
+        
+        results = await asyncio.gather(*pending)
+        return [file_info for file_info in results if file_info]
+    
+    async def _classify(self, process, url, name):
+        """Classify a link with the given processor, reusing results for links to the same file"""
+        # Direct PDF and Drive file links need no request at all
+        file_info = classify_by_url(url, name)
+        if file_info:
+            return file_info
         
-        return new_files
+        key = canonical_link_key(url)
+        cached = self._classify_cache.get(key)
+        if cached is not None:
+            self._classify_cache.move_to_end(key)
+            return {**cached, "url": url, "name": name}
+        
+        # Pages are checked concurrently, so bound the probes they start as well
+        async with self._probe_sem:
+            file_info = await process(url, name)
+        if file_info:
+            self._classify_cache[key] = file_info
+            if len(self._classify_cache) > CLASSIFY_CACHE_SIZE:
+                self._classify_cache.popitem(last=False)
+        return file_info
     
     async def process_resource_link(self, url, name):
         """Process a resource link to determine if it's a PDF"""
         try:
-            # Clean the name - remove ALL accesshide spans completely
-            name = re.sub(r'<span class="accesshide[^>]*>.*?</span>', '', name, flags=re.DOTALL)
-            # Also clean up any trailing/leading spaces
-            name = name.strip()
-            
-            # Rest of the function remains the same
             # Validate URL before proceeding
             if not url or url.strip() == '':
                 logger.warning(f"Empty resource URL found for '{name}', skipping")
@@ -427,7 +816,7 @@ class PDFMonitor:
             if not url.startswith(('http://', 'https://')):
                 url = 'https://' + url
                 
-            response = self.session.session.get(url, allow_redirects=True)
+            response = await self.session.probe(url)
             content_type = response.headers.get('Content-Type', '')
             
             # Direct PDF detection
@@ -436,26 +825,23 @@ class PDFMonitor:
                     "url": url,
                     "name": name,
                     "type": "pdf",
-                    "final_url": response.url
+                    "final_url": str(response.url)
                 }
             
             # Check for PDF in URL 
-            if response.url.lower().endswith('.pdf'):
+            if str(response.url).lower().endswith('.pdf'):
                 return {
                     "url": url,
                     "name": name,
                     "type": "pdf",
-                    "final_url": response.url
+                    "final_url": str(response.url)
                 }
             
             # If it's HTML, it might be a redirect page
             if 'text/html' in content_type:
-                soup = BeautifulSoup(response.text, 'html.parser')
                 # Look for a direct link that might be the actual file
-                main_link = soup.find('a', href=True)
-                if main_link and main_link['href'].strip():
-                    target_url = main_link['href']
-                    
+                target_url = first_link(response.text)
+                if target_url and target_url.strip():
                     # Add scheme if missing in target URL
                     if not target_url.startswith(('http://', 'https://')):
                         target_url = 'https://' + target_url
@@ -476,7 +862,7 @@ class PDFMonitor:
                         }
             
             return None
-        except requests.exceptions.InvalidURL as e:
+        except httpx.InvalidURL as e:
             logger.error(f"Error processing resource link: {e}")
             return None
         except Exception as e:
@@ -486,12 +872,6 @@ class PDFMonitor:
     async def process_url_link(self, url, name):
         """Process a URL link to determine if it leads to a PDF or Drive"""
         try:
-            # Clean the name - remove ALL accesshide spans completely
-            name = re.sub(r'<span class="accesshide[^>]*>.*?</span>', '', name, flags=re.DOTALL)
-            # Also clean up any trailing/leading spaces
-            name = name.strip()
-            
-            # Rest of the function remains the same
             # Validate URL before proceeding
             if not url or url.strip() == '':
                 logger.warning(f"Empty URL found for '{name}', skipping")
@@ -501,15 +881,39 @@ class PDFMonitor:
             if not url.startswith(('http://', 'https://')):
                 url = 'https://' + url
                 
-            response = self.session.session.get(url, allow_redirects=True)
+            response = await self.session.probe(url)
+            content_type = response.headers.get('Content-Type', '')
+            final_url = str(response.url)
+            
+            # The probe already followed Moodle's redirect, so the response itself may be the file
+            if 'application/pdf' in content_type or final_url.lower().endswith('.pdf'):
+                return {
+                    "url": url,
+                    "name": name,
+                    "type": "pdf",
+                    "final_url": final_url
+                }
+            
+            if 'drive.google.com' in final_url:
+                return {
+                    "url": url,
+                    "name": name,
+                    "type": "drive",
+                    "final_url": final_url
+                }
+            
+            if 'youtube.com' in final_url or 'youtu.be' in final_url:
+                return {
+                    "url": url,
+                    "name": name,
+                    "type": "youtube",
+                    "final_url": final_url
+                }
             
             # Check if it's a redirect page
-            soup = BeautifulSoup(response.text, 'html.parser')
-            redirect_link = soup.find('a', href=True)
+            target_url = first_link(response.text)
             
-            if redirect_link:
-                target_url = redirect_link['href']
-                
+            if target_url:
                 # Skip empty target URLs
                 if not target_url or target_url.strip() == '':
                     return None
@@ -546,18 +950,21 @@ class PDFMonitor:
                     }
             
             return None
-        except requests.exceptions.InvalidURL as e:
+        except httpx.InvalidURL as e:
             logger.error(f"Error processing URL link: {e}")
             return None
         except Exception as e:
             logger.error(f"Error processing URL link: {e}")
             return None
     
-    async def send_file_notification(self, bot, chat_id, module_name, file_info):
-        """Send notification about new file to the specified chat"""
+    async def send_file_notification(self, bot, chat_id, module_name, file_info, downloads=None):
+        """Send notification about new file to the specified chat
+
+        downloads maps the final URLs worth keeping for later sends to their content
+        (None until first fetched); other files are downloaded and released right away.
+        """
         try:
-            cleaned_name = re.sub(r'URL|Fichier', '', file_info['name']).strip()
-            message = f"\n📄 *{cleaned_name}*"
+            message = f"\n📄 *{file_info['name']}*"
             
             # Extract the chat ID and thread ID if this is a topic format
             thread_id = None
@@ -582,60 +989,43 @@ class PDFMonitor:
             if file_info['type'] == 'youtube':
                 # For YouTube links, just send the link
                 kwargs["text"] = f"{message}\n\n🎬 YouTube video: {file_info['final_url']}"
-                await bot.send_message(**kwargs)
+                await send_with_retry(bot.send_message, **kwargs)
                 # Add a delay to avoid rate limiting
                 await asyncio.sleep(1)
             
             elif file_info['type'] == 'drive' or file_info['type'] == 'pdf':
                 # For both PDFs and Drive files, download and send the file
-                cleaned_name = re.sub(r'\s*(Fichier|URL|Dossier|Document|File|Link|Resource)\s*$', '', file_info['name'], flags=re.IGNORECASE)
-                # Then sanitize for filesystem
-                sanitized_name = re.sub(r'[^\w\.-]', '_', cleaned_name.strip())
+                # Sanitize the (already cleaned) name for filesystem
+                sanitized_name = _UNSAFE_FILENAME_RE.sub('_', file_info['name'])
                 filename = f"{sanitized_name}.pdf"
                 
-                # Download the file without sending a status message
-                file_path = await self.session.download_file(file_info['final_url'], filename)
+                # Download the file without sending a status message,
+                # reusing it if another module already got the same file
+                final_url = file_info['final_url']
+                file_bytes = downloads.get(final_url) if downloads else None
+                if file_bytes is None:
+                    file_bytes = await self.session.download_bytes(final_url, filename)
+                    if file_bytes and downloads and final_url in downloads:
+                        downloads[final_url] = file_bytes
                 
-                if file_path and file_path.exists() and file_path.stat().st_size > 0:
-                    # Send the file
-                    try:
-                        with open(file_path, 'rb') as f:
-                            kwargs["document"] = f
-                            kwargs["filename"] = filename
-                            kwargs["caption"] = message
-                            await bot.send_document(**kwargs)
-                        # Add a delay to avoid rate limiting
-                        await asyncio.sleep(2)
-                    except telegram.error.RetryAfter as e:
-                        # Handle rate limiting
-                        logger.warning(f"Rate limited. Waiting {e.retry_after} seconds")
-                        await asyncio.sleep(e.retry_after)
-                        # Try again after waiting
-                        with open(file_path, 'rb') as f:
-                            kwargs["document"] = f
-                            kwargs["filename"] = filename
-                            kwargs["caption"] = message
-                            await bot.send_document(**kwargs)
-                    finally:
-                        # Delete the file after sending or if an error occurred
-                        if file_path.exists():
-                            file_path.unlink()
+                if file_bytes:
+                    # Send the file (as bytes, so a retry can send it again)
+                    kwargs["document"] = file_bytes
+                    kwargs["filename"] = filename
+                    kwargs["caption"] = message
+                    await send_with_retry(bot.send_document, **kwargs)
+                    # Add a delay to avoid rate limiting
+                    await asyncio.sleep(2)
                 else:
                     # If download failed, send a message with the link as fallback
                     kwargs["text"] = f"{message}\n\n⚠️ Couldn't download the file. Access it directly: {file_info['final_url']}"
-                    await bot.send_message(**kwargs)
+                    await send_with_retry(bot.send_message, **kwargs)
                     # Add a delay to avoid rate limiting
                     await asyncio.sleep(1)
             
             logger.info(f"Sent notification for {file_info['name']} to chat {chat_id}")
             return True
         
-        except telegram.error.RetryAfter as e:
-            # Handle rate limiting
-            logger.warning(f"Rate limited. Waiting {e.retry_after} seconds")
-            await asyncio.sleep(e.retry_after)
-            # Try recursively after waiting
-            return await self.send_file_notification(bot, chat_id, module_name, file_info)
         except Exception as e:
             logger.error(f"Error sending file notification: {e}")
             # Send error notification with the link as fallback
@@ -650,14 +1040,61 @@ class PDFMonitor:
             return False
 
 # Telegram Bot Commands
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Send a message when the command /start is issued."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
+# Static keyboards, built once instead of on every callback
+CONFIRM_ADD_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("✅ Confirm", callback_data="confirm_add"),
+    InlineKeyboardButton("❌ Cancel", callback_data="cancel_add")
+]])
+CANCEL_REMOVE_ROW = (InlineKeyboardButton("Cancel", callback_data="cancel_remove"),)
+
+def remove_keyboard(module_id):
+    """Build the keep/delete history keyboard for a module."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Remove module only", callback_data=f"cr|keep|{module_id}")],
+        [InlineKeyboardButton("Remove module and history", callback_data=f"cr|delete|{module_id}")],
+        CANCEL_REMOVE_ROW
+    ])
+
+ADMIN_IDS = frozenset({CONFIG["ADMIN_ID"]})
+
+# Seconds between two "not authorized" replies to the same user
+UNAUTHORIZED_REPLY_INTERVAL = 60
+UNAUTHORIZED_TEXT = "Sorry, you are not authorized to use this bot."
+# User ID -> time of the last reply, oldest first
+_last_unauthorized_reply = OrderedDict()
+
+async def reject_non_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop updates from anyone but the admins before any handler sees them."""
+    user = update.effective_user
+    if user and user.id in ADMIN_IDS:
         return
     
+    # Only answer commands and button presses, at most once a minute per user
+    message = update.message
+    is_command = bool(message and message.text and message.text.startswith('/'))
+    if user and (update.callback_query or is_command):
+        now = time.monotonic()
+        # Forget users whose interval is over so the map can't grow without bound
+        while _last_unauthorized_reply:
+            oldest_id, replied_at = next(iter(_last_unauthorized_reply.items()))
+            if now - replied_at < UNAUTHORIZED_REPLY_INTERVAL:
+                break
+            del _last_unauthorized_reply[oldest_id]
+        
+        if user.id not in _last_unauthorized_reply:
+            _last_unauthorized_reply[user.id] = now
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer(UNAUTHORIZED_TEXT)
+                else:
+                    await message.reply_text(UNAUTHORIZED_TEXT)
+            except telegram.error.TelegramError as e:
+                logger.warning(f"Error sending unauthorized reply: {e}")
+    
+    raise ApplicationHandlerStop
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a message when the command /start is issued."""
     welcome_message = (
         "🎓 *E-Learning Monitor Bot* 🎓\n\n"
         "This bot monitors your university's e-learning platform for new PDF files and other resources.\n\n"
@@ -674,12 +1111,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
     help_message = (
         "🎓 *E-Learning Monitor Bot Help* 🎓\n\n"
         "*Commands:*\n"
@@ -699,16 +1130,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def test_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test login to the university platform."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
     await update.message.reply_text("Attempting to login to the university platform...")
     
-    univ_session = UnivSession()
-    success = await univ_session.login()
+    pdf_monitor = context.bot_data["pdf_monitor"]
+    success = await pdf_monitor.session.login()
     
     if success:
         await update.message.reply_text("✅ Login successful! Your credentials are working.")
@@ -717,12 +1142,6 @@ async def test_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def add_module_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the process of adding a new module."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return ConversationHandler.END
-    
     # Parse command arguments
     args = context.args
     
@@ -741,12 +1160,20 @@ async def add_module_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     module_name = " ".join(args[:-1])
     
     # Try to extract the module ID from the URL
-    try:
-        parsed_url = urllib.parse.urlparse(module_url)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
-        module_id = query_params.get('id', ['unknown'])[0]
-    except:
-        module_id = f"module_{int(time.time())}"  # Fallback to a timestamp-based ID
+    module_id = f"module_{int(time.time())}"  # Fallback to a timestamp-based ID
+    if '?' in module_url:
+        try:
+            query = _split_url(module_url).query
+        except ValueError:
+            # Malformed URL (e.g. a bad IPv6 host), keep the fallback ID
+            pass
+        else:
+            # Only the "id" parameter is needed, so scan for it instead of building a dict;
+            # like parse_qs, skip empty values and decode the one that is used
+            module_id = next(
+                (urllib.parse.unquote_plus(value) for key, value in (pair.split('=', 1) for pair in query.split('&') if '=' in pair) if key == 'id' and value),
+                module_id
+            )
     
     # Store the data for later use
     context.user_data["add_module"] = {
@@ -757,7 +1184,7 @@ async def add_module_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Ask the user where to send notifications
     keyboard = [
-        [InlineKeyboardButton("This chat", callback_data=f"chat_{update.effective_chat.id}")],
+        [InlineKeyboardButton("This chat", callback_data=f"chat|{update.effective_chat.id}")],
         [InlineKeyboardButton("Another chat", callback_data="select_other")]
     ]
     
@@ -776,32 +1203,23 @@ async def select_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    if query.data.startswith("chat_"):
+    if query.data.startswith("chat|"):
         # User selected the current chat
         # Keep as integer for regular chats
-        chat_id = int(query.data.split("_")[1])
+        chat_id = int(query.data.split("|", 1)[1])
         
         # Save the selected chat ID
         module_data = context.user_data["add_module"]
         module_data["chat_id"] = chat_id
         
         # Show confirmation
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Confirm", callback_data="confirm_add"),
-                InlineKeyboardButton("❌ Cancel", callback_data="cancel_add")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             f"I'll send updates for *{module_data['name']}* to this chat.\n\n"
             f"*Module:* {module_data['name']}\n"
             f"*URL:* {module_data['url']}\n"
             f"*Destination:* Chat ID {chat_id}\n\n"
             "Is this correct?",
-            reply_markup=reply_markup,
+            reply_markup=CONFIRM_ADD_KB,
             parse_mode=ParseMode.MARKDOWN
         )
         
@@ -834,17 +1252,11 @@ async def handle_chat_id_input(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id_text = update.message.text.strip()
     
     try:
-        # Check if it's a topic ID format (contains underscore)
-        if "_" in chat_id_text:
-            parts = chat_id_text.split("_")
-            # Validate both parts are integers
-            base_chat = int(parts[0])
-            topic_id = int(parts[1])
-            # Use the original string format to preserve the topic format
-            chat_id = chat_id_text
-        else:
-            # Regular chat ID
-            chat_id = int(chat_id_text)
+        match = TOPIC_RE.match(chat_id_text)
+        if not match:
+            raise ValueError(chat_id_text)
+        # Keep topic IDs in their original string format, regular chat IDs as integers
+        chat_id = chat_id_text if match.group(2) else int(match.group(1))
         
         # Save the selected chat ID
         module_data = context.user_data["add_module"]
@@ -852,15 +1264,6 @@ async def handle_chat_id_input(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data["waiting_for_chat_id"] = False
         
         # Show confirmation
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Confirm", callback_data="confirm_add"),
-                InlineKeyboardButton("❌ Cancel", callback_data="cancel_add")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         # Escape the chat_id for markdown by surrounding it with backticks
         display_chat_id = f"`{chat_id}`"
         
@@ -870,7 +1273,7 @@ async def handle_chat_id_input(update: Update, context: ContextTypes.DEFAULT_TYP
             f"*URL:* {module_data['url']}\n"
             f"*Destination:* Chat ID {display_chat_id}\n\n"
             "Is this correct?",
-            reply_markup=reply_markup,
+            reply_markup=CONFIRM_ADD_KB,
             parse_mode=ParseMode.MARKDOWN
         )
         
@@ -898,11 +1301,7 @@ async def complete_module_addition(update: Update, context: ContextTypes.DEFAULT
                 await query.edit_message_text("❌ Error: Module data is missing or incomplete.")
                 return ConversationHandler.END
             
-            # Create a new UnivSession
-            univ_session = UnivSession()
-            
-            # Create PDFMonitor
-            pdf_monitor = PDFMonitor(univ_session)
+            pdf_monitor = context.bot_data["pdf_monitor"]
             
             # Add the module
             module_id = module_data.get("id")
@@ -933,46 +1332,39 @@ async def complete_module_addition(update: Update, context: ContextTypes.DEFAULT
     
     return ConversationHandler.END
 
+@functools.lru_cache(maxsize=512)
+def format_added_at(iso_timestamp):
+    """Format a module's ISO "added_at" timestamp for display."""
+    return datetime.fromisoformat(iso_timestamp).strftime('%Y-%m-%d %H:%M')
+
 async def list_modules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all modules being monitored."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    pdf_monitor = PDFMonitor(UnivSession())
+    pdf_monitor = context.bot_data["pdf_monitor"]
     modules = pdf_monitor.modules
     
     if not modules:
         await update.message.reply_text("No modules are currently being monitored.")
         return
     
-    message = "📚 *Modules Being Monitored* 📚\n\n"
+    # Collect the lines and join them once at the end
+    parts = ["📚 *Modules Being Monitored* 📚", ""]
     
     for module_id, module_info in modules.items():
-        message += f"*{module_info['name']}*\n"
-        message += f"URL: `{module_info['url']}`\n"
-        message += f"Chat ID: `{module_info['chat_id']}`\n"
+        parts.append(f"*{module_info['name']}*")
+        parts.append(f"URL: `{module_info['url']}`")
+        parts.append(f"Chat ID: `{module_info['chat_id']}`")
         
         # Add timestamp when the module was added
         if 'added_at' in module_info:
-            added_at = datetime.fromisoformat(module_info['added_at'])
-            message += f"Added: {added_at.strftime('%Y-%m-%d %H:%M')}\n"
+            parts.append(f"Added: {format_added_at(module_info['added_at'])}")
         
-        message += "\n"
+        parts.append("")
     
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text("\n".join(parts), parse_mode=ParseMode.MARKDOWN)
 
 async def remove_module(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Remove a module from monitoring."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
-    pdf_monitor = PDFMonitor(UnivSession())
+    pdf_monitor = context.bot_data["pdf_monitor"]
     modules = pdf_monitor.modules
     
     if not modules:
@@ -984,12 +1376,12 @@ async def remove_module(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for module_id, module_info in modules.items():
         button = InlineKeyboardButton(
             module_info['name'], 
-            callback_data=f"remove_{module_id}"
+            callback_data=f"rm|{module_id}"
         )
         keyboard.append([button])
     
     # Add cancel button
-    keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel_remove")])
+    keyboard.append(CANCEL_REMOVE_ROW)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -1008,28 +1400,21 @@ async def handle_remove_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("Operation cancelled.")
         return
     
-    if query.data.startswith("remove_"):
-        module_id = query.data[7:]  # Remove 'remove_' prefix
+    if query.data.startswith("rm|"):
+        module_id = query.data[3:]  # Remove 'rm|' prefix
         
-        pdf_monitor = PDFMonitor(UnivSession())
-        module_name = pdf_monitor.modules.get(module_id, {}).get('name', 'Unknown module')
+        pdf_monitor = context.bot_data["pdf_monitor"]
+        info = pdf_monitor.modules.get(module_id)
+        module_name = info['name'] if info else 'Unknown module'
         
         # Store the module ID in context for the confirmation step
         context.user_data["module_to_remove"] = module_id
         context.user_data["module_name"] = module_name
         
         # Ask if user wants to delete sent links data too
-        keyboard = [
-            [InlineKeyboardButton("Remove module only", callback_data=f"confirm_remove_{module_id}_keep_history")],
-            [InlineKeyboardButton("Remove module and history", callback_data=f"confirm_remove_{module_id}_delete_history")],
-            [InlineKeyboardButton("Cancel", callback_data="cancel_remove")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             f"How do you want to remove module *{module_name}*?",
-            reply_markup=reply_markup,
+            reply_markup=remove_keyboard(module_id),
             parse_mode=ParseMode.MARKDOWN
         )
 
@@ -1038,68 +1423,49 @@ async def handle_remove_confirmation(update: Update, context: ContextTypes.DEFAU
     query = update.callback_query
     await query.answer()
     
-    if query.data == "cancel_remove":
-        await query.edit_message_text("Operation cancelled.")
-        return
+    # Format is "cr|[keep/delete]|[module_id]", the module ID goes last so it may contain anything;
+    # the handler pattern already guarantees the action
+    _, action, module_id = query.data.split("|", 2)
     
-    if query.data.startswith("confirm_remove_"):
-        # Parse the callback data with proper handling
-        parts = query.data.split("_")
-        if len(parts) >= 5:
-            # Format is "confirm_remove_[module_id]_[keep/delete]_history"
-            # If module_id contains underscores, we need to join those parts
-            action_index = len(parts) - 2  # Second-to-last part is the action
-            module_id_parts = parts[2:action_index]
-            module_id = "_".join(module_id_parts)
-            action = parts[action_index]  # "keep" or "delete"
-            
-            pdf_monitor = PDFMonitor(UnivSession())
-            module_name = pdf_monitor.modules.get(module_id, {}).get('name', 'Unknown module')
-            
-            # Remove the module from monitoring
-            result = pdf_monitor.remove_module(module_id)
-            
-            # If user chose to delete history, remove sent links data too
-            if action == "delete" and result:
-                if module_id in pdf_monitor.sent_links:
-                    del pdf_monitor.sent_links[module_id]
-                    pdf_monitor.save_data()
-                    await query.edit_message_text(
-                        f"✅ Module *{module_name}* and its history have been removed.",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    await query.edit_message_text(
-                        f"✅ Module *{module_name}* has been removed. No history was found.",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-            elif result:
-                await query.edit_message_text(
-                    f"✅ Module *{module_name}* has been removed. History data was kept.",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            else:
-                await query.edit_message_text("❌ Failed to remove the module.")
+    pdf_monitor = context.bot_data["pdf_monitor"]
+    info = pdf_monitor.modules.get(module_id)
+    module_name = info['name'] if info else 'Unknown module'
+    
+    # Remove the module from monitoring
+    result = pdf_monitor.remove_module(module_id)
+    
+    # If user chose to delete history, remove sent links data too
+    # Both changes only mark the data dirty, the deferred flush saves them in one write
+    history_found = action == "delete" and result and pdf_monitor.delete_history(module_id)
+    
+    if action == "delete" and result:
+        if history_found:
+            await query.edit_message_text(
+                f"✅ Module *{module_name}* and its history have been removed.",
+                parse_mode=ParseMode.MARKDOWN
+            )
         else:
-            await query.edit_message_text("❌ Error processing the request: Invalid callback data.")
+            await query.edit_message_text(
+                f"✅ Module *{module_name}* has been removed. No history was found.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+    elif result:
+        await query.edit_message_text(
+            f"✅ Module *{module_name}* has been removed. History data was kept.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    else:
+        await query.edit_message_text("❌ Failed to remove the module.")
 
 async def check_modules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manually check all modules for updates."""
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
     # Send the checking message and store the message object
     checking_msg = await update.message.reply_text("🔍 Checking modules for new files...")
     
-    # Create session and monitor
-    univ_session = UnivSession()
-    pdf_monitor = PDFMonitor(univ_session)
+    pdf_monitor = context.bot_data["pdf_monitor"]
     
-    # Test login first
-    login_success = await univ_session.login()
+    # Make sure we're logged in (a no-op if the session is still fresh)
+    login_success = await pdf_monitor.session.ensure_logged_in()
     if not login_success:
         # Delete checking message
         await checking_msg.delete()
@@ -1112,24 +1478,22 @@ async def check_modules_command(update: Update, context: ContextTypes.DEFAULT_TY
     # Send completed message and store the message object
     completed_msg = await update.message.reply_text("✅ Check completed!")
     
-    # Delete both messages after a short delay
-    await asyncio.sleep(3)  # 3 seconds delay
-    
-    try:
-        await checking_msg.delete()
-        await completed_msg.delete()
-    except Exception as e:
-        logger.error(f"Error deleting messages: {e}")
+    # Delete both messages after a short delay, without keeping this handler busy
+    context.job_queue.run_once(delete_messages_job, when=3, data=[checking_msg, completed_msg])
+
+async def delete_messages_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job queue callback deleting the messages passed as job data."""
+    # Delete them concurrently rather than one API call after the other
+    results = await asyncio.gather(*(message.delete() for message in context.job.data), return_exceptions=True)
+    for result in results:
+        if isinstance(result, telegram.error.RetryAfter):
+            logger.warning("Rate limited while deleting messages.")
+        elif isinstance(result, Exception):
+            logger.error(f"Error deleting messages: {result}")
 
 async def link_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Link the current chat for future module additions."""
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    
-    if user_id != CONFIG["ADMIN_ID"]:
-        await update.message.reply_text("Sorry, you are not authorized to use this bot.")
-        return
-    
     message_thread_id = update.message.message_thread_id
     
     if message_thread_id:
@@ -1151,18 +1515,19 @@ async def scheduled_check(app):
     """Run scheduled check for updates."""
     logger.info("Running scheduled check...")
     
-    # Create session and monitor
-    univ_session = UnivSession()
-    pdf_monitor = PDFMonitor(univ_session)
+    pdf_monitor = app.bot_data["pdf_monitor"]
     
-    # Login
-    login_success = await univ_session.login()
+    # Login if the session isn't fresh
+    login_success = await pdf_monitor.session.ensure_logged_in()
+    bot = app.bot
     if not login_success:
         logger.error("Scheduled check: Login failed")
         # Optionally notify admin of login failure
+        admin_id = CONFIG["ADMIN_ID"]
+        send = bot.send_message
         try:
-            await app.bot.send_message(
-                chat_id=CONFIG["ADMIN_ID"],
+            await send(
+                chat_id=admin_id,
                 text="❌ Scheduled check failed: Login error"
             )
         except Exception as e:
@@ -1170,18 +1535,19 @@ async def scheduled_check(app):
         return
     
     # Run the check
-    bot = app.bot
     await pdf_monitor.check_modules(bot)
     
     logger.info("Scheduled check completed")
 
-def run_scheduled_check(app):
-    """Run the scheduled check in the event loop."""
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        asyncio.run_coroutine_threadsafe(scheduled_check(app), loop)
-    else:
-        loop.run_until_complete(scheduled_check(app))
+async def scheduled_check_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job queue callback for the daily check."""
+    await scheduled_check(context.application)
+
+async def shutdown(application):
+    """Write pending data and close the university session when the bot stops."""
+    pdf_monitor = application.bot_data["pdf_monitor"]
+    await pdf_monitor.flush()
+    await pdf_monitor.session.close()
 
 async def error_handler(update, context):
     """Log errors caused by updates."""
@@ -1194,10 +1560,12 @@ async def error_handler(update, context):
         return
     
     # If update is available, notify the user about the error
-    if update and update.effective_chat:
+    chat = update.effective_chat if update else None
+    if chat:
+        send = context.bot.send_message
         try:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
+            await send(
+                chat_id=chat.id,
                 text="An error occurred while processing your request. Please try again later."
             )
         except telegram.error.RetryAfter:
@@ -1209,7 +1577,20 @@ async def error_handler(update, context):
 def main():
     """Start the bot."""
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(CONFIG["BOT_TOKEN"]).build()
+    # Bot API calls share pooled HTTP/2 connections instead of a new handshake each;
+    # getUpdates gets its own request object so long polling never blocks a pool slot
+    application = (
+        Application.builder()
+        .token(CONFIG["BOT_TOKEN"])
+        .request(HTTPXRequest(http_version="2", connection_pool_size=BOT_POOL_SIZE, pool_timeout=5.0))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        .post_shutdown(shutdown)
+        .build()
+    )
+    
+    # One session and monitor shared by every handler, so data is loaded
+    # once and login cookies are reused between commands
+    application.bot_data["pdf_monitor"] = PDFMonitor(UnivSession())
 
     # conversation handler for adding modules
     add_module_conv = ConversationHandler(
@@ -1217,15 +1598,24 @@ def main():
         states={
             SELECTING_CHAT: [
                 # Change this line to handle both patterns
-                CallbackQueryHandler(select_chat, pattern=r"^chat_"),
+                CallbackQueryHandler(select_chat, pattern=r"^chat\|"),
                 CallbackQueryHandler(select_other_chat, pattern=r"^select_other$"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_chat_id_input)
             ],
             CONFIRM_ADDITION: [CallbackQueryHandler(complete_module_addition)]
         },
-        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)]
+        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+        # Key the state on user and chat, and drop flows abandoned for 5 minutes
+        per_user=True,
+        per_chat=True,
+        conversation_timeout=ADD_MODULE_TIMEOUT,
+        name="add_module",
+        persistent=False
     )
 
+    # Drop updates from non-admins before they reach any other handler
+    application.add_handler(TypeHandler(Update, reject_non_admin), group=-1)
+    
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -1240,33 +1630,37 @@ def main():
     # Handler for the initial module selection
     application.add_handler(CallbackQueryHandler(
         handle_remove_callback, 
-        pattern=r"^(remove_[0-9a-zA-Z_]+|cancel_remove)$"
+        pattern=r"^(rm\|.+|cancel_remove)$"
     ))
 
     # Handler for the confirmation step
     application.add_handler(CallbackQueryHandler(
         handle_remove_confirmation, 
-        pattern=r"^confirm_remove_[0-9a-zA-Z_]+_(keep|delete)_history$"
+        pattern=r"^cr\|(keep|delete)\|"
     ))
 
-    # Set up the scheduler
-    schedule.every().day.at("08:00").do(run_scheduled_check, app=application)
+    # The daily check runs on PTB's job queue, which needs the "job-queue" extra
+    if application.job_queue is None:
+        raise RuntimeError("Job queue unavailable. Install python-telegram-bot[job-queue]")
     
-    # Start the scheduler in a separate thread
-    import threading
+    # Check every day at 08:00 local time on the bot's own event loop
+    local_tz = ZoneInfo(CONFIG["TIMEZONE"])
+    application.job_queue.run_daily(scheduled_check_job, time=dtime(hour=8, tzinfo=local_tz))
     
-    def run_scheduler():
-        while True:
-            schedule.run_pending()
-            time.sleep(60)  # Check every minute
-    
-    scheduler_thread = threading.Thread(target=run_scheduler)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
     application.add_error_handler(error_handler)
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if CONFIG["WEBHOOK_URL"]:
+        # Telegram pushes updates to us, nothing is polled while idle
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=CONFIG["WEBHOOK_PORT"],
+            url_path=CONFIG["BOT_TOKEN"],
+            webhook_url=f"{CONFIG['WEBHOOK_URL'].rstrip('/')}/{CONFIG['BOT_TOKEN']}",
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":